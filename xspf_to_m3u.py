@@ -1,52 +1,112 @@
 #!/usr/bin/env python3
 import argparse
+import io
+import os
+import shutil
 import sys
+import tempfile
+# Stdlib ElementTree silently degrades to pure Python when _elementtree is
+# missing; require the C accelerator so parsing stays fast.
+try:
+    import _elementtree  # noqa: F401
+except ImportError as e:
+    raise ImportError(
+        "xspf_to_m3u requires the C-accelerated ElementTree (_elementtree)"
+    ) from e
 import xml.etree.ElementTree as ET
 from urllib.parse import urlparse, unquote
 from pathlib import Path
+from functools import lru_cache
+from collections import namedtuple
 
-XSPF_NS = {"x": "http://xspf.org/ns/0/"}
+TRACKLIST_TAG = "{http://xspf.org/ns/0/}trackList"
+TRACK_TAG = "{http://xspf.org/ns/0/}track"
+LOCATION_TAG = "{http://xspf.org/ns/0/}location"
+TITLE_TAG = "{http://xspf.org/ns/0/}title"
+CREATOR_TAG = "{http://xspf.org/ns/0/}creator"
+DURATION_TAG = "{http://xspf.org/ns/0/}duration"
 
-def extract_text(el, tag):
-    child = el.find(f"{{{XSPF_NS['x']}}}{tag}")
-    return (child.text or "").strip() if child is not None and child.text else ""
-
-def extract_location(track_el):
-    loc_el = track_el.find("{http://xspf.org/ns/0/}location")
-    if loc_el is None or not (loc_el.text or "").strip():
-        return None
-    return loc_el.text.strip()
+# duration_s is None when the track has no <duration>
+Track = namedtuple("Track", "path title creator duration_s")
 
 def uri_to_path(uri: str) -> str:
     # Decode file:// URIs and normalize separators
-    if "://" in uri:
-        p = urlparse(uri)
-        raw_path = unquote(p.path or "")
+    if "://" not in uri:
+        return uri.replace("\\", "/") if "\\" in uri else uri
+    if uri[:7].lower() == "file://" and not any(c in uri for c in "?#\t\r\n"):
+        # Common case: slice the path after the authority instead of urlparse
+        rest = uri[7:]
+        slash = rest.find("/")
+        raw_path = rest[slash:] if slash >= 0 else ""
     else:
-        raw_path = uri
-    return raw_path.replace("\\", "/")
+        raw_path = urlparse(uri).path or ""
+    if "%" in raw_path:
+        raw_path = unquote(raw_path)
+    return raw_path.replace("\\", "/") if "\\" in raw_path else raw_path
+
+def _tidy(path: str) -> str:
+    """Drop empty and "." components; only a strip and a few substring checks for clean paths."""
+    path = path.strip("/")
+    if ("//" in path or "/./" in path or path[:2] == "./" or path[-2:] == "/."
+            or path == "."):
+        return "/".join(p for p in path.split("/") if p not in ("", "."))
+    return path
+
+@lru_cache(maxsize=4096)
+def _rel_dir(directory: str, anchor_set: frozenset):
+    """
+    Apply strip_to_rel's rules to a track's (tidied) parent directory.
+    Returns (kept, anchored): the part of the directory to keep ("" for none)
+    and whether an anchor matched. A small LRU suffices: an album's tracks
+    usually arrive together, so the cache stays bounded while streaming.
+    """
+    if anchor_set:
+        lower = directory.lower()
+        if len(lower) == len(directory):
+            # Earliest "/<anchor>/" in the path wins; offsets line up with directory
+            wrapped = f"/{lower}/"
+            best, best_len = -1, 0
+            for a in anchor_set:
+                i = wrapped.find(f"/{a}/")
+                if i >= 0 and (best < 0 or i < best):
+                    best, best_len = i, len(a)
+            if best >= 0:
+                return directory[best + best_len + 1:], True
+        else:
+            # Lowercasing changed the length (rare Unicode); compare per component
+            parts = directory.split("/")
+            for i, part in enumerate(parts):
+                if part.lower() in anchor_set:
+                    return "/".join(parts[i+1:]), True
+    # Drop home prefix (only when the full path keeps at least one component)
+    if directory.startswith(("home/", "Users/")):
+        rest = directory.partition("/")[2]
+        slash = rest.find("/")
+        directory = rest[slash+1:] if slash >= 0 else ""
+    # Keep at most the last 2 directory components (3 with the basename)
+    cut = len(directory)
+    for _ in range(2):
+        cut = directory.rfind("/", 0, cut)
+        if cut < 0:
+            return directory, False
+    return directory[cut+1:], False
 
-def strip_to_rel(path: str, anchors=()):
+def strip_to_rel(path: str, anchor_set=frozenset()):
     """
     Strip leading path up to and including any of the given anchors (case-insensitive).
+    anchor_set holds the anchor names already lowercased (see main()).
     If no anchor is found, apply heuristics:
       - Drop /home/<user>/ or /Users/<user>/ prefix if present.
       - Return last 3 components if >=3, else last 2, else basename.
     """
-    parts = [p for p in path.split("/") if p not in ("", ".")]
-    lower_anchors = {a.lower() for a in anchors}
-    for i, part in enumerate(parts):
-        if part.lower() in lower_anchors:
-            rest = parts[i+1:]
-            return "/".join(rest) if rest else (parts[-1] if parts else "")
-    # Drop home prefix
-    if len(parts) > 2 and parts[0] in ("home", "Users"):
-        parts = parts[2:]
-    if len(parts) >= 3:
-        return "/".join(parts[-3:])
-    if len(parts) == 2:
-        return "/".join(parts[-2:])
-    return parts[-1] if parts else ""
+    path = _tidy(path)
+    directory, slash, base = path.rpartition("/")
+    if not slash:
+        return path
+    kept, anchored = _rel_dir(directory, anchor_set)
+    if not anchored and base.lower() in anchor_set:
+        return base
+    return f"{kept}/{base}" if kept else base
 
 def display_title(creator: str, title: str, path_rel: str) -> str:
     if creator and title:
@@ -56,32 +116,59 @@ def display_title(creator: str, title: str, path_rel: str) -> str:
     return Path(path_rel).name
 
 def ms_to_seconds(ms_str: str) -> int:
-    try:
-        ms = int(ms_str)
-        return int((ms + 500) // 1000)  # round
-    except Exception:
-        return -1  # Rockbox ignores if unknown
-
-def parse_tracks(root):
-    tracks_parent = root.find("x:trackList", XSPF_NS)
-    if tracks_parent is None:
-        return []
-    out = []
-    for trk in tracks_parent.findall("x:track", XSPF_NS):
-        loc = extract_location(trk)
-        if not loc:
+    # XSPF durations are non-negative integers; isdecimal() accepts exactly what int() parses
+    if ms_str and ms_str.isdecimal():
+        return (int(ms_str) + 500) // 1000  # round
+    return -1  # Rockbox ignores if unknown
+
+def iter_tracks(path):
+    """
+    Stream track records from an XSPF file, one Track per <track> with a location.
+    Only direct children of the root's first <trackList> are read. Each one is
+    removed from the tree once consumed so memory stays flat.
+    """
+    track_list = None
+    in_list = False
+    depth = 0
+    for event, el in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 2 and track_list is None and el.tag == TRACKLIST_TAG:
+                track_list = el
+                in_list = True
+            continue
+        depth -= 1
+        if not in_list or depth != 2:
+            if el is track_list:
+                in_list = False
             continue
-        p = uri_to_path(loc)
-        title = extract_text(trk, "title")
-        creator = extract_text(trk, "creator")
-        duration_ms = extract_text(trk, "duration")
-        out.append({
-            "path": p,
-            "title": title,
-            "creator": creator,
-            "duration_s": ms_to_seconds(duration_ms) if duration_ms else None,
-        })
-    return out
+        # el is a finished child of <trackList>
+        if el.tag == TRACK_TAG:
+            # One pass over the children; the first occurrence of each field wins
+            loc = title = creator = duration_ms = None
+            for child in el:
+                tag = child.tag
+                if tag == LOCATION_TAG:
+                    if loc is None:
+                        loc = (child.text or "").strip()
+                elif tag == TITLE_TAG:
+                    if title is None:
+                        title = (child.text or "").strip()
+                elif tag == CREATOR_TAG:
+                    if creator is None:
+                        creator = (child.text or "").strip()
+                elif tag == DURATION_TAG:
+                    if duration_ms is None:
+                        duration_ms = (child.text or "").strip()
+            if loc:
+                yield Track(
+                    uri_to_path(loc),
+                    title or "",
+                    creator or "",
+                    ms_to_seconds(duration_ms) if duration_ms else None,
+                )
+        el.clear()
+        del track_list[:]
 
 def join_posix(base: str, rel: str) -> str:
     # Join using forward slashes, avoiding duplicate separators
@@ -123,51 +210,84 @@ Examples:
                          "Implies --no-extm3u.")
     args = ap.parse_args()
 
-    try:
-        tree = ET.parse(args.input_xspf)
-    except ET.ParseError as e:
-        print(f"Error: failed to parse XSPF: {e}", file=sys.stderr)
-        sys.exit(2)
-    root = tree.getroot()
-
-    tracks = parse_tracks(root)
-
-    lines = []
     gonic_mode = bool(args.gonic_base)
-    if not args.no_extm3u and not gonic_mode:
-        lines.append("#EXTM3U")
+    extm3u = not args.no_extm3u and not gonic_mode
 
+    # Lowercase anchors once; a name containing "/" can never match a single component
+    anchor_set = frozenset(a.lower() for a in args.anchors if "/" not in a)
+
+    # An existing regular file (possibly behind a symlink) is only replaced once
+    # the new playlist is complete, so a failed run leaves it untouched. The new
+    # playlist goes to a temp file beside the resolved target, or into memory if
+    # that directory is not writable. New files and non-regular targets
+    # (/dev/stdout, FIFOs) are streamed into directly.
+    out = args.output_m3u
+    real = os.path.realpath(out)
+    tmp_path = None
+    buffered = created = False
+    if os.path.isfile(out):
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(real) + ".",
+                                            suffix=".part", dir=os.path.dirname(real))
+        except OSError:
+            buffered = True
+            f = io.StringIO(newline="\n")
+        else:
+            f = os.fdopen(fd, "w", encoding="utf-8", newline="\n")
+    else:
+        created = not os.path.exists(out)
+        f = open(out, "w", encoding="utf-8", newline="\n")
     seen = set()
-    for t in tracks:
-        rel = strip_to_rel(t["path"], anchors=args.anchors)
-        if not rel:
-            continue
-        # Determine output path
-        out_path = join_posix(args.gonic_base, rel) if gonic_mode else rel
-        if out_path in seen:
-            continue
-        seen.add(out_path)
-
-        if not args.no_extm3u and not gonic_mode:
-            dur = t["duration_s"]
-            dur_val = dur if isinstance(dur, int) and dur >= 0 else -1
-            disp = display_title(t["creator"], t["title"], rel)
-            lines.append(f"#EXTINF:{dur_val},{disp}")
-        lines.append(out_path)
-
-    # If Gonic mode, prepend the GONIC headers
-    if gonic_mode:
-        name = Path(args.output_m3u).stem or ""
-        gonic_headers = [
-            f'#GONIC-NAME:"{name}"',
-            '#GONIC-COMMENT:""',
-            '#GONIC-IS-PUBLIC:"false"',
-        ]
-        lines = gonic_headers + lines
-
-    with open(args.output_m3u, "w", encoding="utf-8", newline="\n") as f:
-        for l in lines:
-            f.write(l + "\n")
+    # Bind per-track helpers to locals to skip global lookups in the loop
+    _strip, _join, _disp = strip_to_rel, join_posix, display_title
+    gonic_base = args.gonic_base
+    try:
+        if tmp_path:
+            shutil.copymode(real, tmp_path)
+        with f:
+            if gonic_mode:
+                name = Path(args.output_m3u).stem or ""
+                f.write(f'#GONIC-NAME:"{name}"\n'
+                        '#GONIC-COMMENT:""\n'
+                        '#GONIC-IS-PUBLIC:"false"\n')
+            elif extm3u:
+                f.write("#EXTM3U\n")
+
+            write, seen_add = f.write, seen.add
+            for path, title, creator, dur in iter_tracks(args.input_xspf):
+                rel = _strip(path, anchor_set)
+                if not rel:
+                    continue
+                # Determine output path
+                out_path = _join(gonic_base, rel) if gonic_mode else rel
+                # One hash operation: add, then see whether the set grew
+                before = len(seen)
+                seen_add(out_path)
+                if len(seen) == before:
+                    continue
+
+                if extm3u:
+                    dur_val = dur if isinstance(dur, int) and dur >= 0 else -1
+                    disp = _disp(creator, title, rel)
+                    write(f"#EXTINF:{dur_val},{disp}\n{out_path}\n")
+                else:
+                    write(f"{out_path}\n")
+            if buffered:
+                text = f.getvalue()
+    except BaseException as e:
+        if tmp_path:
+            os.remove(tmp_path)
+        elif created:
+            os.remove(real)
+        if isinstance(e, ET.ParseError):
+            print(f"Error: failed to parse XSPF: {e}", file=sys.stderr)
+            sys.exit(2)
+        raise
+    if tmp_path:
+        os.replace(tmp_path, real)
+    elif buffered:
+        with open(real, "w", encoding="utf-8", newline="\n") as f:
+            f.write(text)
 
 if __name__ == "__main__":
     main()